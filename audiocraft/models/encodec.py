@@ -12,7 +12,9 @@ import os
 import logging
 import math
 from pathlib import Path
+import pickle
 import typing as tp
+import zipfile
 
 from einops import rearrange
 import numpy as np
@@ -22,8 +24,9 @@ from transformers import EncodecModel as HFEncodecModel
 
 from .. import quantization as qt
 from ..utils import checkpoint
+from ..utils.autocast import TorchAutocast
 from .scalarmodel import ScalarModel
-from .utils import decimal_to_ternary_matrix, ternary_matrix_to_decimal
+from .utils import pack_ternary, ternary_powers, unpack_ternary
 
 
 logger = logging.getLogger()
@@ -32,7 +35,13 @@ logger = logging.getLogger()
 class CompressionModel(ABC, nn.Module):
     """Base API for all compression models that aim at being used as audio tokenizers
     with a language model.
+
+    Wrappers around external codecs accept a `compact_codes` argument, which makes them return
+    their codes with the smallest integer dtype fitting the cardinality instead of int64:
+    int16 (a quarter of the size) or int32 (half the size). Their `decode` accept any integer dtype,
+    but other consumers (e.g. embeddings or cross entropy targets) may require casting back to long.
     """
+    compact_codes: bool = False
 
     @abstractmethod
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
@@ -88,6 +97,14 @@ class CompressionModel(ABC, nn.Module):
         """Set the active number of codebooks used by the quantizer."""
         ...
 
+    def _maybe_compact_codes(self, codes: torch.Tensor) -> torch.Tensor:
+        """Downcast the codes to a smaller integer dtype if `compact_codes` is set."""
+        if not self.compact_codes:
+            return codes
+        # codes range from 0 to cardinality - 1.
+        dtype = torch.int16 if self.cardinality - 1 <= torch.iinfo(torch.int16).max else torch.int32
+        return codes.to(dtype)
+
     @staticmethod
     def get_pretrained(
             name: str, device: tp.Union[torch.device, str] = 'cpu'
@@ -147,6 +164,15 @@ class EncodecModel(CompressionModel):
         channels (int): Number of audio channels.
         causal (bool): Whether to use a causal version of the model.
         renormalize (bool): Whether to renormalize the audio before running the model.
+        autocast_dtype (str, optional): If set, e.g. to 'bfloat16', the encoder and decoder are run
+            under CUDA autocast with this dtype when the model is not training. The quantizer always
+            runs in full precision.
+        compile_mode (str, optional): If set, the encoder and decoder are compiled with `torch.compile`
+            using this mode, e.g. 'default', 'reduce-overhead' or 'max-autotune'. In `forward`, the
+            encoder, quantizer and decoder are additionally compiled as a single graph.
+        keep_scale_on_cpu (bool): Whether `encode` should return the renormalization scale in (pinned)
+            CPU memory rather than on the input device, to avoid keeping many small device tensors alive
+            when codes are stored for later decoding.
     """
     # we need assignment to override the property in the abstract class,
     # I couldn't find a better way...
@@ -162,7 +188,10 @@ class EncodecModel(CompressionModel):
                  sample_rate: int,
                  channels: int,
                  causal: bool = False,
-                 renormalize: bool = False):
+                 renormalize: bool = False,
+                 autocast_dtype: tp.Optional[str] = None,
+                 compile_mode: tp.Optional[str] = None,
+                 keep_scale_on_cpu: bool = False):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
@@ -172,11 +201,42 @@ class EncodecModel(CompressionModel):
         self.channels = channels
         self.renormalize = renormalize
         self.causal = causal
+        # select the postprocessing once rather than branching on every call.
+        self._postprocess = self._renormalize_postprocess if self.renormalize else self._identity_postprocess
+        self.autocast_dtype = autocast_dtype
+        self.keep_scale_on_cpu = keep_scale_on_cpu
+        self.compile_mode = compile_mode
+        if self.compile_mode is not None and not hasattr(torch, 'compile'):
+            raise RuntimeError("compile_mode requires PyTorch >= 2.0")
+        self._build_compiled()
         if self.causal:
             # we force disabling here to avoid handling linear overlap of segments
             # as supported in original EnCodec codebase.
             assert not self.renormalize, 'Causal model does not support renormalize'
 
+    def _build_compiled(self):
+        """Create the compiled callables used when `compile_mode` is set. They are kept in a plain dict
+        so that they are neither registered as submodules, which would change the state dict, nor copied
+        or pickled with the model, as they reference the instance they were built from.
+        """
+        self._compiled: tp.Dict[str, tp.Callable] = {}
+        if self.compile_mode is None:
+            return
+        self._compiled['encoder'] = torch.compile(self.encoder, mode=self.compile_mode)
+        self._compiled['decoder'] = torch.compile(self.decoder, mode=self.compile_mode)
+        # single graph for forward, so that the encoder output can be fused with the quantizer.
+        # It traces the uncompiled encoder and decoder, the ones above are only used by encode/decode.
+        self._compiled['forward'] = torch.compile(type(self)._encode_quantize_decode, mode=self.compile_mode)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_compiled', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._build_compiled()
+
     @property
     def total_codebooks(self):
         """Total number of quantizer codebooks available."""
@@ -196,11 +256,32 @@ class EncodecModel(CompressionModel):
         """Cardinality of each codebook."""
         return self.quantizer.bins
 
+    def _autocast(self, x: torch.Tensor) -> TorchAutocast:
+        """Autocast context for the encoder and decoder, only enabled for inference on CUDA."""
+        enabled = self.autocast_dtype is not None and not self.training and x.device.type == 'cuda'
+        if not enabled:
+            return TorchAutocast(enabled=False)
+        return TorchAutocast(enabled=True, device_type=x.device.type, dtype=getattr(torch, self.autocast_dtype))
+
+    def _run_encoder(self, x: torch.Tensor, compiled: bool = True) -> torch.Tensor:
+        encoder = self._compiled.get('encoder', self.encoder) if compiled else self.encoder
+        with self._autocast(x):
+            emb = encoder(x)
+        # the quantizer is sensitive to precision, always feed it with the input dtype.
+        return emb.to(x.dtype)
+
+    def _run_decoder(self, emb: torch.Tensor, compiled: bool = True) -> torch.Tensor:
+        decoder = self._compiled.get('decoder', self.decoder) if compiled else self.decoder
+        with self._autocast(emb):
+            out = decoder(emb)
+        return out.to(emb.dtype)
+
     def preprocess(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         scale: tp.Optional[torch.Tensor]
         if self.renormalize:
             mono = x.mean(dim=1, keepdim=True)
-            volume = mono.pow(2).mean(dim=2, keepdim=True).sqrt()
+            # RMS volume, the norm computes the square, sum and sqrt in a single reduction.
+            volume = torch.linalg.vector_norm(mono, dim=2, keepdim=True) / math.sqrt(mono.shape[-1])
             scale = 1e-8 + volume
             x = x / scale
             scale = scale.view(-1, 1)
@@ -211,8 +292,14 @@ class EncodecModel(CompressionModel):
     def postprocess(self,
                     x: torch.Tensor,
                     scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        return self._postprocess(x, scale)
+
+    def _identity_postprocess(self, x: torch.Tensor, scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        return x
+
+    def _renormalize_postprocess(self, x: torch.Tensor, scale: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
         if scale is not None:
-            assert self.renormalize
+            scale = scale.to(x.device, non_blocking=True)
             x = x * scale.view(-1, 1, 1)
         return x
 
@@ -221,18 +308,26 @@ class EncodecModel(CompressionModel):
         length = x.shape[-1]
         x, scale = self.preprocess(x)
 
-        emb = self.encoder(x)
-        q_res = self.quantizer(emb, self.frame_rate)
-        out = self.decoder(q_res.x)
+        # unbound function, called with `self` explicitly.
+        encode_quantize_decode = self._compiled.get('forward', type(self)._encode_quantize_decode)
+        q_res, out = encode_quantize_decode(self, x)
 
         # remove extra padding added by the encoder and decoder
         assert out.shape[-1] >= length, (out.shape[-1], length)
         out = out[..., :length]
 
-        q_res.x = self.postprocess(out, scale)
+        q_res.x = self._postprocess(out, scale)
 
         return q_res
 
+    def _encode_quantize_decode(self, x: torch.Tensor) -> tp.Tuple[qt.QuantizedResult, torch.Tensor]:
+        # the uncompiled modules are used, the whole function being compiled when `compile_mode` is set.
+        emb = self._run_encoder(x, compiled=False)
+        q_res = self.quantizer(emb, self.frame_rate)
+        out = self._run_decoder(q_res.x, compiled=False)
+        return q_res, out
+
+    @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         """Encode the given input tensor to quantized representation along with scale parameter.
 
@@ -246,10 +341,14 @@ class EncodecModel(CompressionModel):
         """
         assert x.dim() == 3
         x, scale = self.preprocess(x)
-        emb = self.encoder(x)
+        emb = self._run_encoder(x)
         codes = self.quantizer.encode(emb)
+        if scale is not None and self.keep_scale_on_cpu and scale.is_cuda:
+            # pinned memory so that moving it back in `postprocess` can be asynchronous.
+            scale = torch.empty(scale.shape, dtype=scale.dtype, pin_memory=True).copy_(scale)
         return codes, scale
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         """Decode the given codes to a reconstructed representation, using the scale to perform
         audio denormalization if needed.
@@ -262,19 +361,27 @@ class EncodecModel(CompressionModel):
             out (torch.Tensor): Float tensor of shape [B, C, T], the reconstructed audio.
         """
         emb = self.decode_latent(codes)
-        out = self.decoder(emb)
-        out = self.postprocess(out, scale)
+        out = self._run_decoder(emb)
+        out = self._postprocess(out, scale)
         # out contains extra padding added by the encoder and decoder
         return out
 
+    @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
         return self.quantizer.decode(codes)
 
 
 class DAC(CompressionModel):
-    def __init__(self, model_type: str = "44khz"):
+    """Wrapper around Descript Audio Codec.
+
+    Args:
+        model_type (str): DAC model type, e.g. '44khz' or '24khz'.
+        compact_codes (bool): Whether to return codes as int16 rather than int64, see `CompressionModel`.
+    """
+    def __init__(self, model_type: str = "44khz", compact_codes: bool = False):
         super().__init__()
+        self.compact_codes = compact_codes
         try:
             import dac.utils
         except ImportError:
@@ -282,24 +389,31 @@ class DAC(CompressionModel):
                                "please run `pip install descript-audio-codec`")
         self.model = dac.utils.load_model(model_type=model_type)
         self.n_quantizers = self.total_codebooks
+        # whether the encoded codes must be truncated to the active codebooks.
+        self._slice_needed = False
         self.model.eval()
 
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
         # We don't support training with this.
         raise NotImplementedError("Forward and training with DAC not supported.")
 
+    @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         codes = self.model.encode(x, self.n_quantizers)[1]
-        return codes[:, :self.n_quantizers], None
+        if self._slice_needed:
+            codes = codes[:, :self.n_quantizers]
+        return self._maybe_compact_codes(codes), None
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         assert scale is None
         z_q = self.decode_latent(codes)
         return self.model.decode(z_q)
 
+    @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
-        return self.model.quantizer.from_codes(codes)[0]
+        return self.model.quantizer.from_codes(codes.long())[0]
 
     @property
     def channels(self) -> int:
@@ -331,6 +445,7 @@ class DAC(CompressionModel):
         assert n >= 1
         assert n <= self.total_codebooks
         self.n_quantizers = n
+        self._slice_needed = n != self.total_codebooks
     
 class SQCodec(CompressionModel):
     """SQCodec adapted tokenizer version for LLM training
@@ -352,10 +467,14 @@ class SQCodec(CompressionModel):
         clip_length=450,
         hidden_dim = None, 
         use_ternary=False,
+        compact_codes=False,
     ):
         """ Make sure to download checkpoint from https://huggingface.co/Dongchao/UniAudio/blob/main/SQ-Codec.zip
+        Set `compact_codes` to return codes as int16 rather than int64, see `CompressionModel`,
+        this applies to both the decimal and the ternary (`use_ternary`) codes.
         """
         super(SQCodec, self).__init__()
+        self.compact_codes = compact_codes
         
         try:
             self.ckpt_path = checkpoint.resolve_checkpoint_path(checkpoint_path, use_fsdp=False)
@@ -380,10 +499,30 @@ class SQCodec(CompressionModel):
             self.proj_layer = None
 
         self.use_ternary = use_ternary
+        # base-3 positional weights, used to pack/unpack ternary digits on device
+        self.register_buffer('_pow3', ternary_powers(self.emb_dim), persistent=False)
     
     def build_codec_model(self,):
         scalar_codec = ScalarModel()  
-        parameter_dict = torch.load(self.ckpt_path)
+        if self.ckpt_path is None:
+            # `resolve_checkpoint_path` returns None when the checkpoint does not exist.
+            raise FileNotFoundError(
+                "SQCodec checkpoint not found. "
+                "1. Download checkpoint - wget https://huggingface.co/Dongchao/UniAudio/resolve/main/SQ-Codec.zip "
+                "2. Make sure ckpt_00190000.pth locates at //reference/pretrained/SQ-Codec/, "
+                "or pass its location as `checkpoint_path`.")
+        # memory map the tensors rather than reading the whole checkpoint in RAM,
+        # load_state_dict then copies them into the model parameters.
+        # Only zipfile checkpoints can be memory mapped, not the legacy format.
+        mmap = zipfile.is_zipfile(self.ckpt_path)
+        if not mmap:
+            logger.info("SQCodec checkpoint uses the legacy format, it will not be memory mapped.")
+        try:
+            parameter_dict = torch.load(self.ckpt_path, map_location='cpu', mmap=mmap, weights_only=True)
+        except pickle.UnpicklingError:
+            # the checkpoint contains more than tensors and plain containers.
+            logger.warning("SQCodec checkpoint cannot be loaded with weights_only, loading it in full.")
+            parameter_dict = torch.load(self.ckpt_path, map_location='cpu', mmap=mmap, weights_only=False)
         scalar_codec.load_state_dict(parameter_dict['codec_model']) # load model
         print('Loaded SQCodec from pretrained checkpoint.')
         return scalar_codec
@@ -426,6 +565,7 @@ class SQCodec(CompressionModel):
         # We don't support training with this.
         raise NotImplementedError("Forward and training with SQCodec not supported.")
 
+    @torch.no_grad()
     def encode(self, x: torch.Tensor):
         """
         Args:
@@ -440,19 +580,15 @@ class SQCodec(CompressionModel):
 
         if self.use_ternary:
             compressed = compressed.to(torch.int64) + 1 # ranging from 0, 1, 2 [bt, 36, 1500]
-            return compressed, None
-
-        chunks = compressed.chunk(self.n_codebook, dim=1) # 
-        codec_ls = []
-        for i, chunk in enumerate(chunks):
-            chunk = chunk.detach().cpu().numpy() #.int() + 1
-            chunk= chunk.astype(np.int32) + 1 # .astype(np.int32) # 
-            tmp_codec = ternary_matrix_to_decimal(chunk) # 
-            codec_ls.append(torch.from_numpy(tmp_codec).to(torch.int64))
+            return self._maybe_compact_codes(compressed), None
 
-        codec_ls = torch.stack(codec_ls, dim=1)
+        B, _, T = compressed.shape
+        # split the channels into n_codebook groups of emb_dim ternary digits and
+        # convert each group to its decimal value, all on device
+        compressed = compressed.view(B, self.n_codebook, self.emb_dim, T)
+        codes = pack_ternary(compressed, self._pow3)  # B, n_codebook, len
 
-        return codec_ls.to('cuda'), None
+        return self._maybe_compact_codes(codes), None
     
     def encode_embedding(self, codes: torch.Tensor):
         """ Get embedding from code (Int type) for encoding/training, as input to a LLM model
@@ -460,25 +596,22 @@ class SQCodec(CompressionModel):
             codes (torch.Tensor): Int tensor of shape [batch, num_codebooks, length]
 
         Returns:
-            
+            in_embs (torch.Tensor, float): ternary digits ranging from -1, 0, 1 of shape
+                [batch, length, num_codebooks, emb_dim], or [batch, length, num_codebooks, hidden_dim]
+                if a projection layer is used.
         """
         assert codes.dim() == 3
-        with torch.no_grad():
-            codes = codes.permute(2, 0, 1)
-            in_embs = []
-            for i in range(self.num_codebooks):
-                tmp_list = decimal_to_ternary_matrix(in_tokens[i, :, :], D=self.emb_dim) - 1
-                in_embs.append(tmp_list)
-            in_embs = torch.stack(in_embs, dim=0).float().to(codes.device)  # Shape: (num_codebooks, B, D, T)
-            # Permute to match (B, T, num_codebook, D)
-            in_embs = in_embs.permute(1, 3, 0, 2)  # Shape: (3, 150, 4, 9)
-        
+        codes = self._to_device(codes)
+        digits = unpack_ternary(codes, self.emb_dim, self._pow3)  # B, K, emb_dim, T
+        in_embs = digits.permute(0, 3, 1, 2).float()  # B, T, K, emb_dim
+
         if self.proj_layer is not None:
             in_embs = self.proj_layer(in_embs)
-        
+
         return in_embs
 
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         
         """Decode the given codes to a reconstructed representation, using the scale to perform
@@ -491,14 +624,20 @@ class SQCodec(CompressionModel):
         """
 
         assert scale == None
+        codes = self._to_device(codes)
         if self.use_ternary:
             codes = codes - 1 # ranging from -1, 0, 1; [bt, 36, 1500]
         else:
             codes = self.decode_latent(codes)
-        out = self.scalar_codec.decode(codes.float().to('cuda'))
+        out = self.scalar_codec.decode(codes.float())
 
         return out
 
+    def _to_device(self, codes: torch.Tensor) -> torch.Tensor:
+        """Move the codes to the model device, the copy is asynchronous if they are in pinned memory."""
+        return codes.to(self._pow3.device, non_blocking=True)
+
+    @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
         """ Get embedding from code (Int type) for decoding
         Args:
@@ -508,15 +647,12 @@ class SQCodec(CompressionModel):
             emb_quant (torch.Tensor, float)
         """
         assert codes.dim() == 3
+        B, K, T = codes.shape
+        codes = self._to_device(codes)
 
-        # for i in range(self.n_codebook):
-        #     codes[:, i, :] -= i * self.dim_codebook
-            
-        emb_quant = []
-        for i in range(self.n_codebook):
-            tmp_list = decimal_to_ternary_matrix(codes[:, i, :], D=self.emb_dim) - 1
-            emb_quant.append(tmp_list)
-        emb_quant = torch.cat(emb_quant, dim=1)
+        # unravel every code into its emb_dim ternary digits at once, ranging from -1, 0, 1
+        digits = unpack_ternary(codes, self.emb_dim, self._pow3)  # B, K, emb_dim, T
+        emb_quant = digits.reshape(B, K * self.emb_dim, T).float()
 
         return emb_quant
 
@@ -532,8 +668,16 @@ class WavTokenizer(CompressionModel):
     def __init__(self,
                  repo_id="novateur/WavTokenizer-medium-music-audio-75token",
                  config="wavtokenizer_mediumdata_music_audio_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml",
-                 checkpoint="wavtokenizer_medium_music_audio_320_24k_v2.ckpt"):
+                 checkpoint="wavtokenizer_medium_music_audio_320_24k_v2.ckpt",
+                 reuse_output_buffer: bool = False,
+                 compact_codes: bool = False):
+        """When `reuse_output_buffer` is True, `decode` writes into a single preallocated buffer
+        that is returned on every call, saving an allocation per call for streaming usage.
+        The returned tensor is then overwritten by the next call to `decode`.
+        When `compact_codes` is True, codes are returned as int16 rather than int64, see `CompressionModel`.
+        """
         super().__init__()
+        self.compact_codes = compact_codes
         from huggingface_hub import snapshot_download
 
         try:
@@ -556,21 +700,36 @@ class WavTokenizer(CompressionModel):
         self.model = wavtokenizer.WavTokenizer.from_pretrained0802(config_path, checkpoint_path)
         self.n_quantizers = self.total_codebooks
         self.model.eval()
+        self.reuse_output_buffer = reuse_output_buffer
+        self._out_buf: tp.Optional[torch.Tensor] = None
+        # constant `bandwidth_id` tensor passed to the decoder, cached per device.
+        self._bw_id_cache: tp.Dict[torch.device, torch.Tensor] = {}
 
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
         # We don't support training with this.
         raise NotImplementedError("Forward and training with WavTokeniser not supported.")
 
+    @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         _, tokens = self.model.encode(x.squeeze(1), bandwidth_id=0)
-        return tokens.movedim(0, 1), None
+        return self._maybe_compact_codes(tokens.movedim(0, 1)), None
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         assert scale is None
-        feats = self.model.codes_to_features(codes.movedim(1, 0))
-        # Clone is required to avoid - "RuntimeError: Inplace update to inference tensor outside InferenceMode is not
+        feats = self.model.codes_to_features(codes.long().movedim(1, 0))
+        bandwidth_id = self._bw_id_cache.get(codes.device)
+        if bandwidth_id is None:
+            bandwidth_id = self._bw_id_cache[codes.device] = torch.tensor(0, device=codes.device)
+        y = self.model.decode(feats, bandwidth_id=bandwidth_id).unsqueeze(1)
+        # A copy is required to avoid - "RuntimeError: Inplace update to inference tensor outside InferenceMode is not
         # allowed.You can make a clone to get a normal tensor before doing inplace update" in clamping and saving
-        return self.model.decode(feats, bandwidth_id=torch.tensor(0, device=codes.device)).unsqueeze(1).clone()
+        if not self.reuse_output_buffer:
+            return y.clone()
+        buf = self._out_buf
+        if buf is None or buf.shape != y.shape or buf.dtype != y.dtype or buf.device != y.device:
+            buf = self._out_buf = torch.empty_like(y)
+        return buf.copy_(y)
 
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
@@ -593,15 +752,21 @@ class WavTokenizer(CompressionModel):
 
 class HFEncodecCompressionModel(CompressionModel):
     """Wrapper around HuggingFace Encodec.
+
+    Args:
+        model (HFEncodecModel): HuggingFace Encodec model to wrap.
+        compact_codes (bool): Whether to return codes as int16 rather than int64, see `CompressionModel`.
     """
-    def __init__(self, model: HFEncodecModel):
+    def __init__(self, model: HFEncodecModel, compact_codes: bool = False):
         super().__init__()
         self.model = model
+        self.compact_codes = compact_codes
+        # the config is fixed, cache the derived frame rate.
+        hop_length = int(np.prod(self.model.config.upsampling_ratios))
+        self._frame_rate = self.sample_rate / hop_length
         bws = self.model.config.target_bandwidths
-        num_codebooks = [
-            bw * 1000 / (self.frame_rate * math.log2(self.cardinality))
-            for bw in bws
-        ]
+        bits_per_frame = self.frame_rate * math.log2(self.cardinality)
+        num_codebooks = [bw * 1000 / bits_per_frame for bw in bws]
         deltas = [nc - int(nc) for nc in num_codebooks]
         # Checking we didn't do some bad maths and we indeed have integers!
         assert all(deltas) <= 1e-3, deltas
@@ -612,25 +777,26 @@ class HFEncodecCompressionModel(CompressionModel):
         # We don't support training with this.
         raise NotImplementedError("Forward and training with HF EncodecModel not supported.")
 
+    @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
-        bandwidth_index = self.possible_num_codebooks.index(self.num_codebooks)
-        bandwidth = self.model.config.target_bandwidths[bandwidth_index]
-        res = self.model.encode(x, None, bandwidth)
+        res = self.model.encode(x, None, self._bandwidth)
         assert len(res[0]) == 1
         assert len(res[1]) == 1
-        return res[0][0], res[1][0]
+        return self._maybe_compact_codes(res[0][0]), res[1][0]
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         if scale is None:
             scales = [None]  # type: ignore
         else:
             scales = scale  # type: ignore
-        res = self.model.decode(codes[None], scales)
+        res = self.model.decode(codes.long()[None], scales)
         return res[0]
 
+    @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
-        return self.model.quantizer.decode(codes.transpose(0, 1))
+        return self.model.quantizer.decode(codes.long().transpose(0, 1))
 
     @property
     def channels(self) -> int:
@@ -638,8 +804,7 @@ class HFEncodecCompressionModel(CompressionModel):
 
     @property
     def frame_rate(self) -> float:
-        hop_length = int(np.prod(self.model.config.upsampling_ratios))
-        return self.sample_rate / hop_length
+        return self._frame_rate
 
     @property
     def sample_rate(self) -> int:
@@ -663,6 +828,9 @@ class HFEncodecCompressionModel(CompressionModel):
         if n not in self.possible_num_codebooks:
             raise ValueError(f"Allowed values for num codebooks: {self.possible_num_codebooks}")
         self._num_codebooks = n
+        # cache the matching bandwidth so that `encode` does not have to look it up
+        bandwidth_index = self.possible_num_codebooks.index(n)
+        self._bandwidth = self.model.config.target_bandwidths[bandwidth_index]
 
 
 class InterleaveStereoCompressionModel(CompressionModel):
@@ -676,11 +844,15 @@ class InterleaveStereoCompressionModel(CompressionModel):
         model (CompressionModel): Compression model to wrap.
         per_timestep (bool): Whether to interleave on the timestep dimension
             or on the codebooks dimension.
+        reuse_output_buffer (bool): Whether `decode` should write into a single preallocated
+            buffer returned on every call, which is then overwritten by the next call.
     """
-    def __init__(self, model: CompressionModel, per_timestep: bool = False):
+    def __init__(self, model: CompressionModel, per_timestep: bool = False, reuse_output_buffer: bool = False):
         super().__init__()
         self.model = model
         self.per_timestep = per_timestep
+        self.reuse_output_buffer = reuse_output_buffer
+        self._stereo_out: tp.Optional[torch.Tensor] = None
         assert self.model.channels == 1, "Wrapped model is expected to be for monophonic audio"
 
     @property
@@ -731,16 +903,18 @@ class InterleaveStereoCompressionModel(CompressionModel):
     def forward(self, x: torch.Tensor) -> qt.QuantizedResult:
         raise NotImplementedError("Not supported, use encode and decode.")
 
+    @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
         B, C, T = x.shape
         assert C == self.channels, f"Expecting stereo audio but audio num channels is {C}"
 
-        indices_c0, scales_c0 = self.model.encode(x[:, 0, ...].unsqueeze(1))
-        indices_c1, scales_c1 = self.model.encode(x[:, 1, ...].unsqueeze(1))
-        indices = torch.stack([indices_c0, indices_c1], dim=0)
-        scales: tp.Optional[torch.Tensor] = None
-        if scales_c0 is not None and scales_c1 is not None:
-            scales = torch.stack([scales_c0, scales_c1], dim=1)
+        # encode both channels with a single call by folding them into the batch dimension,
+        # rows are ordered as [L_0, ..., L_{B-1}, R_0, ..., R_{B-1}].
+        x = x.permute(1, 0, 2).reshape(2 * B, 1, T)
+        indices, scales = self.model.encode(x)
+        indices = indices.view(2, B, *indices.shape[1:])
+        if scales is not None:
+            scales = scales.view(2, B, *scales.shape[1:]).transpose(0, 1)
 
         if self.per_timestep:
             indices = rearrange(indices, 'c b k t -> b k (t c)', c=2)
@@ -756,21 +930,28 @@ class InterleaveStereoCompressionModel(CompressionModel):
             codes = rearrange(codes, 'b (k c) t -> c b k t', c=2)
         return codes[0], codes[1]
 
+    @torch.no_grad()
     def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
         B, K, T = codes.shape
         assert T % self.num_virtual_steps == 0, "Provided codes' number of timesteps does not match"
         assert K == self.num_codebooks, "Provided codes' number of codebooks does not match"
 
-        scale_c0, scale_c1 = None, None
         if scale is not None:
             assert scale.size(0) == B and scale.size(1) == 2, f"Scale has unexpected shape: {scale.shape}"
-            scale_c0 = scale[0, ...]
-            scale_c1 = scale[1, ...]
+            # same layout as the batched codes, [2B, ...] with the left channel first.
+            scale = scale.transpose(0, 1).reshape(2 * B, *scale.shape[2:])
 
+        # decode both channels with a single call, folding them into the batch dimension as in `encode`.
         codes_c0, codes_c1 = self.get_left_right_codes(codes)
-        audio_c0 = self.model.decode(codes_c0, scale_c0)
-        audio_c1 = self.model.decode(codes_c1, scale_c1)
-        return torch.cat([audio_c0, audio_c1], dim=1)
+        audio = self.model.decode(torch.cat([codes_c0, codes_c1], dim=0), scale)
+        audio_c0, audio_c1 = audio[:B], audio[B:]
+        if not self.reuse_output_buffer:
+            return torch.cat([audio_c0, audio_c1], dim=1)
+        shape = (B, audio.shape[1] * 2, *audio.shape[2:])
+        out = self._stereo_out
+        if out is None or out.shape != shape or out.dtype != audio.dtype or out.device != audio.device:
+            out = self._stereo_out = audio.new_empty(shape)
+        return torch.cat([audio_c0, audio_c1], dim=1, out=out)
 
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
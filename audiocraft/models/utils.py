@@ -37,6 +37,8 @@ def ternary_matrix_to_decimal(matrix):
     matrix : numpy.ndarray
         A 3D numpy array of shape (B, D, N), where B is the batch size, D is the number
         of ternary digits, and N is the number of ternary numbers in each batch.
+        Any number of leading dimensions is supported, e.g. (B, K, D, N) to convert
+        all the codebooks at once.
 
     Returns
     -------
@@ -44,24 +46,83 @@ def ternary_matrix_to_decimal(matrix):
         A 2D numpy array of shape (B, N), where each value represents the decimal
         equivalent of the corresponding ternary number in the input matrix.
     """
-    (
-        B,
-        D,
-        N,
-    ) = (
-        matrix.shape
-    )  # B is the batch size, D is the number of digits, N is the number of ternary numbers
-    powers_of_three = 3 ** np.arange(D)  # [3^0, 3^1, ..., 3^(D-1)]
+    D = matrix.shape[-2]  # number of ternary digits, matrix is [..., D, N]
+    powers_of_three = 3 ** np.arange(D, dtype=np.int64)  # [3^0, 3^1, ..., 3^(D-1)]
 
-    # Reshape powers_of_three for broadcasting: [D] -> [1, D, 1]
-    powers_of_three = powers_of_three[:, np.newaxis]  # Shape [D, 1]
-
-    # Compute dot product using broadcasting: matrix * powers_of_three along D axis
-    decimals = np.sum(matrix * powers_of_three, axis=1)  # Sum along the D axis
+    # Single weighted reduction over the D axis, without materializing matrix * powers_of_three
+    decimals = np.einsum('...dn,d->...n', matrix, powers_of_three, optimize=True)
 
     return decimals
 
 
+def ternary_powers(D, device=None):
+    """
+    Base-3 positional weights used to pack and unpack ternary digits.
+
+    Arguments
+    ---------
+    D : int
+        Number of ternary digits.
+    device : torch.device, optional
+        Device on which to create the weights.
+
+    Returns
+    -------
+    torch.Tensor
+        A 1D int64 tensor [3^0, 3^1, ..., 3^(D-1)].
+    """
+    return 3 ** torch.arange(D, dtype=torch.int64, device=device)
+
+
+def pack_ternary(digits, powers=None):
+    """
+    Convert a [..., D, T] tensor of ternary digits ranging from -1, 0, 1 to decimal numbers,
+    the first digit being the least significant, as in `decimal_to_ternary_matrix`.
+
+    Arguments
+    ---------
+    digits : torch.Tensor
+        A tensor of shape [..., D, T] with values in -1, 0, 1.
+    powers : torch.Tensor, optional
+        Precomputed output of `ternary_powers(D)`, on the same device as `digits`.
+
+    Returns
+    -------
+    torch.Tensor
+        An int64 tensor of shape [..., T] with values in [0, 3^D).
+    """
+    D = digits.shape[-2]
+    if powers is None:
+        powers = ternary_powers(D, digits.device)
+    # sum((d + 1) * 3^i) = sum(d * 3^i) + sum(3^i), which avoids shifting every digit first.
+    offset = (3 ** D - 1) // 2
+    return (digits.to(torch.int64) * powers.view(-1, 1)).sum(dim=-2) + offset
+
+
+def unpack_ternary(codes, D, powers=None):
+    """
+    Convert a [..., T] tensor of decimal numbers to its D ternary digits ranging from -1, 0, 1,
+    inverse of `pack_ternary`.
+
+    Arguments
+    ---------
+    codes : torch.Tensor
+        An integer tensor of shape [..., T] with values in [0, 3^D).
+    D : int
+        Number of ternary digits to represent each number (depth).
+    powers : torch.Tensor, optional
+        Precomputed output of `ternary_powers(D)`, on the same device as `codes`.
+
+    Returns
+    -------
+    torch.Tensor
+        An int64 tensor of shape [..., D, T] with values in -1, 0, 1.
+    """
+    if powers is None:
+        powers = ternary_powers(D, codes.device)
+    return (codes.to(torch.int64).unsqueeze(-2) // powers.view(-1, 1)) % 3 - 1
+
+
 def get_padding(kernel_size, dilation=1):
     """
     Computes the padding size for a given kernel size and dilation.
@@ -4,14 +4,64 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
+import io
 import random
+import typing as tp
 
 import numpy as np
 import torch
 
-from audiocraft.models import EncodecModel
+from audiocraft.models import CompressionModel, EncodecModel
+from audiocraft.models.encodec import InterleaveStereoCompressionModel
 from audiocraft.modules import SEANetEncoder, SEANetDecoder
-from audiocraft.quantization import DummyQuantizer
+from audiocraft.quantization import BaseQuantizer, DummyQuantizer, ResidualVectorQuantizer
+
+
+class _StubCompressionModel(CompressionModel):
+    """Minimal compression model only exposing a cardinality."""
+    channels: int = 1
+    frame_rate: float = 1
+    sample_rate: int = 1
+    num_codebooks: int = 1
+    total_codebooks: int = 1
+    cardinality: int = 0
+
+    def __init__(self, cardinality: int, compact_codes: bool = False):
+        super().__init__()
+        self.cardinality = cardinality
+        self.compact_codes = compact_codes
+
+    def forward(self, x: torch.Tensor):
+        raise NotImplementedError()
+
+    def encode(self, x: torch.Tensor):
+        raise NotImplementedError()
+
+    def decode(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None):
+        raise NotImplementedError()
+
+    def decode_latent(self, codes: torch.Tensor):
+        raise NotImplementedError()
+
+    def set_num_codebooks(self, n: int):
+        raise NotImplementedError()
+
+
+class TestCompactCodes:
+
+    def test_default_no_op(self):
+        codes = torch.randint(0, 1024, (2, 4, 10))
+        assert _StubCompressionModel(1024)._maybe_compact_codes(codes) is codes
+
+    def test_dtype_cutoff(self):
+        # codes range up to cardinality - 1, 32767 is the largest int16 value.
+        for cardinality, dtype in [(1024, torch.int16), (32768, torch.int16), (32769, torch.int32)]:
+            model = _StubCompressionModel(cardinality, compact_codes=True)
+            codes = torch.tensor([[[0, cardinality - 1]]])
+            compact = model._maybe_compact_codes(codes)
+            assert compact.dtype == dtype
+            assert torch.equal(compact.long(), codes)
 
 
 class TestEncodecModel:
@@ -23,13 +73,15 @@ class TestEncodecModel:
                               n_filters: int = 3,
                               n_residual_layers: int = 1,
                               ratios: list = [5, 4, 3, 2],
+                              quantizer: tp.Optional[BaseQuantizer] = None,
                               **kwargs):
         frame_rate = np.prod(ratios)
         encoder = SEANetEncoder(channels=channels, dimension=dim, n_filters=n_filters,
                                 n_residual_layers=n_residual_layers, ratios=ratios)
         decoder = SEANetDecoder(channels=channels, dimension=dim, n_filters=n_filters,
                                 n_residual_layers=n_residual_layers, ratios=ratios)
-        quantizer = DummyQuantizer()
+        if quantizer is None:
+            quantizer = DummyQuantizer()
         model = EncodecModel(encoder, decoder, quantizer, frame_rate=frame_rate,
                              sample_rate=sample_rate, channels=channels, **kwargs)
         return model
@@ -58,3 +110,129 @@ class TestEncodecModel:
             codes, scales = model_nonorm.encode(x)
             codes, scales = model_renorm.encode(x)
             assert scales is not None
+
+    def test_model_renorm_decode(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        channels = 1
+        model_nonorm = self._create_encodec_model(sample_rate, channels, renormalize=False)
+        model_renorm = self._create_encodec_model(sample_rate, channels, renormalize=True)
+        model_renorm.load_state_dict(model_nonorm.state_dict())
+
+        x = torch.randn(2, channels, 1200)
+        codes, scale = model_renorm.encode(x)
+        assert scale is not None
+        out = model_renorm.decode(codes, scale)
+        assert torch.allclose(out, model_nonorm.decode(codes) * scale.view(-1, 1, 1))
+        # without a scale, decoding is left unscaled.
+        assert torch.equal(model_renorm.decode(codes), model_nonorm.decode(codes))
+
+    def test_model_autocast_cpu(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        channels = 1
+        model = self._create_encodec_model(sample_rate, channels).eval()
+        model_autocast = self._create_encodec_model(sample_rate, channels, autocast_dtype='bfloat16').eval()
+        model_autocast.load_state_dict(model.state_dict())
+        x = torch.randn(2, channels, 1200)
+        # autocast is only enabled on CUDA, CPU outputs are unchanged.
+        codes, _ = model.encode(x)
+        codes_autocast, _ = model_autocast.encode(x)
+        assert codes_autocast.dtype == torch.float32
+        assert torch.equal(codes, codes_autocast)
+        assert torch.equal(model.decode(codes), model_autocast.decode(codes_autocast))
+
+    def test_model_compile_forward(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        channels = 1
+        model = self._create_encodec_model(sample_rate, channels)
+        model_compiled = self._create_encodec_model(sample_rate, channels, compile_mode='default')
+        model_compiled.load_state_dict(model.state_dict())
+        x = torch.randn(2, channels, 1200)
+        res = model(x)
+        res_compiled = model_compiled(x)
+        assert res_compiled.x.shape == res.x.shape == x.shape
+        assert torch.allclose(res_compiled.x, res.x, atol=1e-5)
+
+    def test_model_keep_scale_on_cpu(self):
+        torch.manual_seed(1234)
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        model = self._create_encodec_model(24_000, 1, renormalize=True, keep_scale_on_cpu=True).to(device)
+        x = torch.randn(2, 1, 1200, device=device)
+        codes, scale = model.encode(x)
+        assert scale is not None
+        assert scale.device.type == 'cpu'
+        out = model.decode(codes, scale)
+        assert out.device == x.device
+        assert torch.equal(out, model.decode(codes, scale.to(device)))
+
+    def test_model_compile(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        channels = 1
+        model = self._create_encodec_model(sample_rate, channels).eval()
+        model_compiled = self._create_encodec_model(sample_rate, channels, compile_mode='default').eval()
+        assert model_compiled.state_dict().keys() == model.state_dict().keys()
+        model_compiled.load_state_dict(model.state_dict())
+
+        x = torch.randn(2, channels, 1200)
+        codes, _ = model.encode(x)
+        codes_compiled, _ = model_compiled.encode(x)
+        assert torch.allclose(codes, codes_compiled, atol=1e-5)
+        out = model_compiled.decode(codes_compiled)
+        assert torch.allclose(model.decode(codes), out, atol=1e-5)
+
+        # copies must run their own weights, not the ones of the original model.
+        model_copy = copy.deepcopy(model_compiled)
+        for param in model_copy.decoder.parameters():
+            param.data.add_(1.)
+        assert not torch.allclose(model_copy.decode(codes_compiled), out)
+
+        buffer = io.BytesIO()
+        torch.save(model_compiled, buffer)
+        buffer.seek(0)
+        model_loaded = torch.load(buffer, weights_only=False)
+        assert torch.allclose(model_loaded.decode(codes_compiled), out, atol=1e-5)
+
+    def _create_stereo_model(self, per_timestep: bool) -> InterleaveStereoCompressionModel:
+        # the dummy quantizer returns [B, 1, D, T] codes, so use a real (random) codebook
+        # to get the [B, K, T] codes the stereo wrapper interleaves.
+        quantizer = ResidualVectorQuantizer(dimension=5, n_q=2, bins=16, kmeans_init=False)
+        model = self._create_encodec_model(24_000, 1, quantizer=quantizer, renormalize=True)
+        return InterleaveStereoCompressionModel(model.eval(), per_timestep=per_timestep)
+
+    def test_interleave_stereo_encode(self):
+        torch.manual_seed(1234)
+        B = 3
+        x = torch.randn(B, 2, 1200)
+        for per_timestep in [False, True]:
+            stereo = self._create_stereo_model(per_timestep)
+            codes, scales = stereo.encode(x)
+            K, T = stereo.model.encode(x[:, :1])[0].shape[1:]
+            if per_timestep:
+                assert codes.shape == (B, K, 2 * T)
+            else:
+                assert codes.shape == (B, 2 * K, T)
+            assert scales is not None
+            assert scales.shape == (B, 2, 1)
+            for channel, channel_codes in enumerate(stereo.get_left_right_codes(codes)):
+                ref_codes, ref_scale = stereo.model.encode(x[:, channel:channel + 1])
+                assert torch.equal(channel_codes, ref_codes)
+                assert torch.allclose(scales[:, channel], ref_scale)
+
+    def test_interleave_stereo_decode(self):
+        torch.manual_seed(1234)
+        B = 3
+        x = torch.randn(B, 2, 1200)
+        for per_timestep in [False, True]:
+            stereo = self._create_stereo_model(per_timestep)
+            codes, scales = stereo.encode(x)
+            assert scales is not None
+            out = stereo.decode(codes, scales)
+            assert out.shape[:2] == (B, 2)
+            expected = torch.cat([
+                stereo.model.decode(channel_codes, scales[:, channel])
+                for channel, channel_codes in enumerate(stereo.get_left_right_codes(codes))
+            ], dim=1)
+            assert torch.allclose(out, expected, atol=1e-5)
@@ -0,0 +1,49 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.models.utils import (
+    decimal_to_ternary_matrix, pack_ternary, ternary_matrix_to_decimal, ternary_powers, unpack_ternary)
+
+
+class TestTernary:
+
+    def test_unpack_matches_decimal_to_ternary_matrix(self):
+        D = 9
+        codes = torch.arange(3 ** D).view(1, -1)
+        digits = unpack_ternary(codes, D)
+        assert digits.shape == (1, D, 3 ** D)
+        # decimal_to_ternary_matrix divides its input inplace.
+        expected = decimal_to_ternary_matrix(codes.clone(), D=D) - 1
+        assert torch.equal(digits, expected)
+
+    def test_round_trip(self):
+        D = 9
+        codes = torch.arange(3 ** D).view(1, 1, -1)
+        powers = ternary_powers(D)
+        digits = unpack_ternary(codes, D, powers)
+        assert digits.min() == -1 and digits.max() == 1
+        assert torch.equal(pack_ternary(digits, powers), codes)
+        # float digits, as returned by the SQCodec encoder, are also supported.
+        assert torch.equal(pack_ternary(digits.float()), codes)
+
+    def test_pack_offset(self):
+        D = 9
+        digits = torch.randint(-1, 2, (2, 4, D, 17))
+        shifted = ((digits + 1) * ternary_powers(D).view(-1, 1)).sum(dim=-2)
+        assert torch.equal(pack_ternary(digits), shifted)
+        assert pack_ternary(torch.full((1, D, 1), -1)).item() == 0
+        assert pack_ternary(torch.ones(1, D, 1)).item() == 3 ** D - 1
+
+    def test_ternary_matrix_to_decimal(self):
+        D = 9
+        for shape in [(2, D, 17), (2, 4, D, 17)]:
+            digits = torch.randint(-1, 2, shape)
+            # the NumPy helper expects digits ranging from 0, 1, 2.
+            decimals = ternary_matrix_to_decimal((digits + 1).numpy())
+            assert decimals.shape == shape[:-2] + shape[-1:]
+            assert torch.equal(torch.from_numpy(decimals), pack_ternary(digits))
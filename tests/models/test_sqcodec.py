@@ -0,0 +1,48 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import typing as tp
+
+import pytest
+import torch
+from torch import nn
+
+from audiocraft.models.encodec import SQCodec
+from audiocraft.models.utils import ternary_powers, unpack_ternary
+
+
+class TestSQCodec:
+
+    def _create_sqcodec(self, emb_dim: int = 9, hidden_dim: tp.Optional[int] = None) -> SQCodec:
+        # bypass __init__, which requires the pretrained checkpoint.
+        model = SQCodec.__new__(SQCodec)
+        nn.Module.__init__(model)
+        model.emb_dim = emb_dim
+        model.proj_layer = nn.Linear(emb_dim, hidden_dim) if hidden_dim is not None else None
+        model.register_buffer('_pow3', ternary_powers(emb_dim), persistent=False)
+        return model
+
+    def test_encode_embedding(self):
+        B, K, T, D = 2, 4, 5, 9
+        model = self._create_sqcodec(emb_dim=D)
+        codes = torch.randint(0, 3 ** D, (B, K, T))
+        in_embs = model.encode_embedding(codes)
+        assert in_embs.shape == (B, T, K, D)
+        assert in_embs.dtype == torch.float32
+        expected = unpack_ternary(codes, D).permute(0, 3, 1, 2).float()
+        assert torch.equal(in_embs, expected)
+        # digits of the code of batch item 1, codebook 2 and timestep 3.
+        assert torch.equal(in_embs[1, 3, 2], unpack_ternary(codes[1:2, 2, 3:4], D)[0, :, 0].float())
+
+    def test_encode_embedding_projection(self):
+        B, K, T, D = 2, 4, 5, 9
+        model = self._create_sqcodec(emb_dim=D, hidden_dim=16)
+        codes = torch.randint(0, 3 ** D, (B, K, T))
+        assert model.encode_embedding(codes).shape == (B, T, K, 16)
+
+    def test_missing_checkpoint(self, tmp_path):
+        with pytest.raises(FileNotFoundError, match="SQCodec checkpoint not found"):
+            SQCodec(checkpoint_path=str(tmp_path / 'missing.pth'))